@@ -0,0 +1,107 @@
+"""
+Compiled kernels that accumulate the precipitation sums and sample counts in
+each x-y bin, and match the instrument samples in time. numba is optional: if 
+it is not installed the kernels are None and the numpy paths are used instead.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _accumulate(x, y, w, x_min, x_max, x_inv, n_x, y_min, y_max, y_inv, n_y, sums, counts, n_blocks):
+    """
+    Add the samples to the sums and counts grids in a single pass. The bins
+    must be evenly spaced so the bin index is ceil((value-min)*inv)-1, where
+    inv is the number of bins divided by the bin range. Like the original 
+    binning loop, each bin includes its end edge but not its start edge. 
+    Bin_Data only calls it if this arithmetic is exact for its bin edges. The samples are split into
+    one block per thread, and each block is binned into its own grids that 
+    are added up at the end, so the threads never write to the same bin.
+
+    Parameters
+    ----------
+    x, y, w: np.array
+        The x, y, and precipitation values of each sample.
+    x_min, y_min: float
+        The first x and y bin edges.
+    x_max, y_max: float
+        The last x and y bin edges.
+    x_inv, y_inv: float
+        The inverse of the x and y bin widths.
+    n_x, n_y: int
+        The number of x and y bins.
+    sums, counts: np.array
+        The (n_x, n_y) grids that are updated in place.
+    n_blocks: int
+        The number of sample blocks, usually numba.get_num_threads().
+    """
+    block_size = (x.shape[0] + n_blocks - 1)//n_blocks
+    block_sums = np.zeros((n_blocks, n_x, n_y))
+    block_counts = np.zeros((n_blocks, n_x, n_y), dtype=np.int64)
+    for b in numba.prange(n_blocks):
+        for k in range(b*block_size, min((b+1)*block_size, x.shape[0])):
+            # NaNs fail these comparisons so they are skipped too.
+            if not ((x[k] > x_min) and (x[k] <= x_max) and (y[k] > y_min) and (y[k] <= y_max)):
+                continue
+            i = min(max(int(np.ceil((x[k]-x_min)*x_inv)) - 1, 0), n_x-1)
+            j = min(max(int(np.ceil((y[k]-y_min)*y_inv)) - 1, 0), n_y-1)
+            block_sums[b, i, j] += w[k]
+            block_counts[b, i, j] += 1
+    for b in range(n_blocks):
+        sums += block_sums[b]
+        counts += block_counts[b]
+    return
+
+
+def _nearest_index(times, ref_times, tolerance):
+    """
+    Find the index of the nearest ref_times sample for each sample in times
+    by walking both (sorted) arrays once.
+
+    Parameters
+    ----------
+    times: np.array
+        The sorted times to match.
+    ref_times: np.array
+        The sorted reference times.
+    tolerance: int
+        The maximum allowed time difference between the matched samples.
+
+    Returns
+    -------
+    np.array
+        The ref_times indices, or -1 if the nearest ref_times sample is further
+        than tolerance away.
+    """
+    idx = np.full(times.shape[0], -1, dtype=np.int64)
+    if ref_times.shape[0] == 0:
+        return idx
+    j = 0
+    for i in range(times.shape[0]):
+        # Step to the last ref_times sample at or before times[i]. Comparing
+        # the times (not the distances) steps over duplicate ref_times too.
+        while (j+1 < ref_times.shape[0]) and (ref_times[j+1] <= times[i]):
+            j += 1
+        # Use the next sample only if it is closer, so ties keep the earlier
+        # sample like pd.merge_asof.
+        nearest = j
+        if (j+1 < ref_times.shape[0]) and (
+                abs(ref_times[j+1]-times[i]) < abs(ref_times[j]-times[i])):
+            nearest = j+1
+        if abs(ref_times[nearest]-times[i]) <= tolerance:
+            idx[i] = nearest
+    return idx
+
+
+if numba is not None:
+    # fastmath is left off since it assumes that there are no NaNs, and the
+    # samples without a matching attitude are NaNs.
+    # nogil lets the instrument load the next day in another thread.
+    accumulate = numba.njit(cache=True, parallel=True, nogil=True)(_accumulate)
+    nearest_index = numba.njit(cache=True, nogil=True)(_nearest_index)
+else:
+    accumulate = None
+    nearest_index = None
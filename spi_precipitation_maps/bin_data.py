@@ -1,9 +1,16 @@
+import os
+import sys
 import pathlib
+import warnings
+import multiprocessing
+import concurrent.futures
 from typing import Union, ClassVar
 
 import pandas as pd
 import numpy as np
-import progressbar
+
+from spi_precipitation_maps import _binning
+from spi_precipitation_maps import utils
 
 
 class Bin_Data:
@@ -14,16 +21,26 @@ class Bin_Data:
     Parameters
     ----------
     x_bins: np.array
-        The x bins used to histogram the data.
+        The x bins used to histogram the data. Each bin includes its end 
+        edge but not its start edge, i.e., (x_bins[i], x_bins[i+1]].
     y_bins: np.array
-        The y bins used to histogram the data.
+        The y bins used to histogram the data, with the same (start, end] 
+        edges.
     x_col, y_col: str
         The names of the x and y columns to bin.
     precipitation_col: str
         The name of the counts column to bin.
     instrument: str
         The instrument class that supports looping (implements the __iter__ 
-        special method and returns).
+        special method and returns) and implements __len__ for the progress
+        bar. Each chunk is a DataFrame with the x_col, y_col, and 
+        precipitation_col columns, or a dict of float32 or float64 arrays with
+        the "x", "y", and "w" keys. To bin in parallel, the instrument 
+        must also have a dates attribute and a load_day(date) method that 
+        returns the data on that date (or None to skip it).
+    instrument_kwargs: dict
+        The keyword arguments passed to the instrument class when bin() 
+        initializes it.
 
     Example
     -------
@@ -32,15 +49,15 @@ class Bin_Data:
     Attributes
     ----------
     mean: np.array
-        The mean value of precipitation_col in each x-y bin. The array shape is
-        (x_bins.shape[0]-1, y_bins.shape[0]-1).
+        The mean value of precipitation_col in each x-y bin, or NaN if the bin
+        has no samples. The array shape is (x_bins.shape[0]-1, y_bins.shape[0]-1).
     mean_sampes: np.array
         The number of sampes in each x-y bin. The array shape is
         (x_bins.shape[0]-1, y_bins.shape[0]-1).
     """
     def __init__(
         self, x_bins: np.array, y_bins: np.array, x_col: str, y_col: str, 
-        precipitation_col: str, instrument
+        precipitation_col: str, instrument, instrument_kwargs: dict=None
         ) -> None:
         self.x_bins = x_bins
         self.y_bins = y_bins
@@ -48,29 +65,133 @@ class Bin_Data:
         self.y_col = y_col
         self.precipitation_col = precipitation_col
 
-        self.mean = np.zeros((x_bins.shape[0]-1, y_bins.shape[0]-1))
-        self.mean_sampes = np.zeros((x_bins.shape[0]-1, y_bins.shape[0]-1))
+        # Only the sums and counts are accumulated, the mean is calculated 
+        # when it is needed.
+        self._sum = np.zeros((x_bins.shape[0]-1, y_bins.shape[0]-1))
+        self._count = np.zeros((x_bins.shape[0]-1, y_bins.shape[0]-1), dtype=np.int64)
         self.instrument = instrument
+        if instrument_kwargs is None:
+            instrument_kwargs = {}
+        self.instrument_kwargs = instrument_kwargs
+        # The evenly spaced bins are found with index arithmetic instead of a
+        # binary search, but only if round-off can't move a sample on (or 
+        # next to) a bin edge into the wrong bin.
+        self._uniform_bins = _is_uniform(x_bins) and _is_uniform(y_bins)
+        if self._uniform_bins:
+            # The inverse bin widths for the index arithmetic.
+            self._x_inv = (x_bins.shape[0]-1)/(x_bins[-1]-x_bins[0])
+            self._y_inv = (y_bins.shape[0]-1)/(y_bins[-1]-y_bins[0])
+            self._uniform_bins = (
+                _exact_bin_arithmetic(x_bins, self._x_inv) and 
+                _exact_bin_arithmetic(y_bins, self._y_inv)
+                )
         return
 
-    def bin(self):
+    def bin(self, n_workers: int=1, batch_size: int=1, prefetch: bool=False):
         """
         Loop over the instrument data (i.e. files), bin each data chunk by 
         self.x_col and self.y_col, and calculate the average of self.precipitation_col.
+
+        Parameters
+        ----------
+        n_workers: int
+            The number of processes that load and bin the days in parallel. 
+            If 1, the days are binned serially by looping over the instrument.
+            The worker processes are spawned, so the instrument class must be
+            importable from a module (not defined in a notebook or in the 
+            __main__ script), and a script must call bin() under an 
+            `if __name__ == '__main__':` guard.
+        batch_size: int
+            The number of chunks that are concatenated and binned together 
+            when n_workers is 1. Larger batches cut the per-chunk overhead 
+            when the chunks are small, but hold more chunks in memory.
+        prefetch: bool
+            Loop over the instrument in a background thread when n_workers 
+            is 1, so the next chunk is loaded while this one is binned. Only
+            use it if the instrument is thread-safe.
         """
-        instrument = self.instrument()  # Need to initialize the class first.
-        for data in progressbar.progressbar(instrument, redirect_stdout=True):
-            self._bin_data(data)
+        if batch_size < 1:
+            raise ValueError(f'batch_size must be at least 1, not {batch_size}.')
+        # Need to initialize the class first.
+        instrument = self.instrument(**self.instrument_kwargs)
+        if n_workers == 1:
+            chunks = instrument
+            if prefetch:
+                # Load the next day in a background thread while this one is 
+                # binned. The numba kernels release the GIL so both run at once.
+                chunks = utils.prefetch(instrument)
+            batch = []
+            for data in utils.progressbar(chunks, iter_length=len(instrument), redirect_stdout=True):
+                batch.append(data)
+                if len(batch) == batch_size:
+                    self._bin_data(self._concatenate(batch))
+                    batch = []
+            if len(batch):
+                self._bin_data(self._concatenate(batch))
+            return
+
+        # Each day's sums and counts are independent, so the worker processes
+        # bin the days and this process only adds up their grids. The 
+        # Bin_Data and instrument objects are sent to each worker once, 
+        # and then only the dates are sent.
+        # Spawn (not fork) the workers since numba's threading layers are not
+        # fork-safe once the parallel kernel has run in this process.
+        mp_context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=mp_context,
+                initializer=_init_worker, initargs=(self, instrument)
+                ) as executor:
+            futures = [executor.submit(_bin_day, date) for date in instrument.dates]
+            try:
+                # Add the grids as the days finish, so one slow day doesn't 
+                # hold up the rest.
+                for future in utils.progressbar(
+                        concurrent.futures.as_completed(futures), iter_length=len(futures)
+                        ):
+                    grid = future.result()
+                    if grid is not None:
+                        self._add_to_grids(*grid)
+            except BaseException:
+                # If a day failed (or on Ctrl-C), cancel the days that haven't 
+                # started so the error is raised after the running days finish,
+                # instead of after every day.
+                for future in futures:
+                    future.cancel()
+                raise
         return
 
+    @property
+    def mean(self):
+        """
+        The mean value of precipitation_col in each x-y bin, or NaN if the bin
+        has no samples.
+        """
+        return np.divide(
+            self._sum, self._count, 
+            out=np.full_like(self._sum, np.nan), where=self._count > 0
+            )
+
+    @property
+    def mean_sampes(self):
+        """
+        The number of sampes in each x-y bin.
+        """
+        return self._count
+
     def save_map(self, filename: str, save_dir: Union[str, pathlib.Path]=None):
         """
-        Save map to a csv file.
+        Save map to a csv file, or to a compressed npz file if filename ends 
+        with .npz. The npz file also contains the number of samples and the
+        bin edges, and is much faster to write for large maps. The map is 
+        first written to a temporary file and then renamed, so an interrupted
+        save (e.g., in a finally block after Ctrl-C) won't leave a truncated 
+        map behind.
 
         Parameters
         ----------
         filename: str
-            The file name to save the precipitation map, in the csv format.
+            The file name to save the precipitation map, in the csv or npz 
+            format.
         save_dir: str or pathlib.Path
             The directory to save the map to. If None, it will save it to the
             spi_precipitation_maps/data/ folder.
@@ -78,47 +199,231 @@ class Bin_Data:
         Returns
         -------
         pathlib.Path
-            The full file path to the csv file.
+            The full file path to the csv or npz file.
         """
         if save_dir is None:
             save_dir = pathlib.Path(__file__).parent / 'data'
         else:
             save_dir = pathlib.Path(save_dir)
         save_path = save_dir / filename
-        df = pd.DataFrame(
-            data=self.mean, 
-            index=self.x_bins[:-1], 
-            columns=self.y_bins[:-1]
-            )
-        df.to_csv(save_path)
+        tmp_path = save_path.with_name(save_path.name + '.tmp')
+
+        if save_path.suffix == '.npz':
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(
+                    f, mean=self.mean, count=self.mean_sampes, 
+                    x_bins=self.x_bins, y_bins=self.y_bins
+                    )
+        else:
+            if self._sum.size > 100*100:
+                warnings.warn(
+                    f'Saving a {self._sum.shape} map to a csv file is slow. '
+                    f'Use a .npz file name instead.'
+                    )
+            df = pd.DataFrame(
+                data=self.mean, 
+                index=self.x_bins[:-1], 
+                columns=self.y_bins[:-1]
+                )
+            df.to_csv(tmp_path)
+        os.replace(tmp_path, save_path)
         return save_path
 
     def _bin_data(self, merged):
         """
-        Groups the SAMPEX data in each L and MLT and calculates self.stat statistic
-        on the grouped counts.
-        """
-        for i, (start_x, end_x) in enumerate(zip(self.x_bins[:-1], self.x_bins[1:])):
-            for j, (start_y, end_y) in enumerate(zip(self.y_bins[:-1], self.y_bins[1:])):
-                filtered_data = merged.loc[
-                    (merged.loc[:, self.x_col] > start_x) &
-                    (merged.loc[:, self.x_col] <= end_x) &
-                    (merged.loc[:, self.y_col] > start_y) &
-                    (merged.loc[:, self.y_col] <= end_y),
-                    :
-                ]
-                if filtered_data.shape[0] == 0:
-                    continue
-                # Calculate incremental mean since were looping over many days.
-                # https://math.stackexchange.com/questions/106700/incremental-averaging
-                # https://ubuntuincident.wordpress.com/2012/04/25/calculating-the-average-incrementally/
-                # Maybe this for loop can be replaced by itertools.accumulate?
-                # for _, row in filtered_data.iterrows():
-                #     adjustment = (row[self.counts_col] - self.mean[i, j])/self.mean_sampes[i, j]
-                #     self.mean[i, j] += adjustment
-                #     self.mean_sampes[i, j] += 1
-                self.mean[i,j] = (
-                    self.mean_sampes[i, j]*self.mean[i,j] + np.sum(filtered_data[self.precipitation_col])
-                    )/(self.mean_sampes[i, j]+filtered_data.shape[0])
-                self.mean_sampes[i,j] += filtered_data.shape[0]
-        return
\ No newline at end of file
+        Histogram the data chunk in each x-y bin and add the chunk's sums and
+        sample counts to the running totals.
+        """
+        self._add_to_grids(*self._sum_and_count(merged))
+        return
+
+    def _sum_and_count(self, merged):
+        """
+        Calculate the sum of self.precipitation_col and the number of samples
+        in each x-y bin of the data chunk. The chunk is either a DataFrame, or 
+        a dict with the x, y, and precipitation arrays under the "x", "y", and
+        "w" keys.
+        """
+        x, y, w = self._arrays(merged)
+        if x.shape[0]*_SPARSE_BINS_PER_SAMPLE < self._sum.size:
+            # Most of the bins are empty, so only add up the occupied ones.
+            return self._sparse_histogram(x, y, w)
+        if (_binning.accumulate is not None) and self._uniform_bins:
+            # The compiled kernel skips the out-of-range samples itself.
+            sums = np.zeros_like(self._sum)
+            counts = np.zeros_like(self._count)
+            _binning.accumulate(
+                x, y, w, 
+                float(self.x_bins[0]), float(self.x_bins[-1]), self._x_inv, sums.shape[0], 
+                float(self.y_bins[0]), float(self.y_bins[-1]), self._y_inv, sums.shape[1], 
+                sums, counts, _binning.numba.get_num_threads()
+                )
+        else:
+            sums, counts = self._histogram(x, y, w)
+        return sums, counts
+
+    def _arrays(self, merged):
+        """
+        Get the x, y, and precipitation arrays from a DataFrame or dict chunk.
+        """
+        if isinstance(merged, dict):
+            return merged['x'], merged['y'], merged['w']
+        return (
+            merged[self.x_col].to_numpy(dtype=np.float64),
+            merged[self.y_col].to_numpy(dtype=np.float64),
+            merged[self.precipitation_col].to_numpy(dtype=np.float64)
+            )
+
+    def _concatenate(self, chunks):
+        """
+        Concatenate a list of chunks into one dict chunk so they are binned
+        in one call.
+        """
+        if len(chunks) == 1:
+            return chunks[0]
+        x, y, w = zip(*[self._arrays(chunk) for chunk in chunks])
+        return {'x':np.concatenate(x), 'y':np.concatenate(y), 'w':np.concatenate(w)}
+
+    def _add_to_grids(self, sums, counts, occupied=None):
+        """
+        Add a chunk's sums and counts to the running totals. The sum and count
+        are associative, so the chunks can be added in any order. If occupied
+        is given, sums and counts are only for those (unique) flattened bins.
+        """
+        if occupied is None:
+            self._sum += sums
+            self._count += counts
+        else:
+            self._sum.reshape(-1)[occupied] += sums
+            self._count.reshape(-1)[occupied] += counts
+        return
+
+    def _histogram(self, x, y, w):
+        """
+        Calculate the sum of w and the number of samples in each x-y bin 
+        using index arithmetic for the evenly spaced bins, or a binary search 
+        over the bin edges otherwise.
+        """
+        flat_idx, w = self._flat_indices(x, y, w)
+        n_x, n_y = self._sum.shape
+        sums = np.bincount(flat_idx, weights=w, minlength=n_x*n_y)
+        counts = np.bincount(flat_idx, minlength=n_x*n_y)
+        return sums.reshape(n_x, n_y), counts.reshape(n_x, n_y)
+
+    def _sparse_histogram(self, x, y, w):
+        """
+        Calculate the sum of w and the number of samples in the occupied x-y
+        bins by sorting the samples by bin and summing each run of equal bins.
+        Faster than _histogram when there are far fewer samples than bins, 
+        since the grids are never allocated.
+
+        Returns
+        -------
+        sums, counts, occupied: np.array
+            The sums and counts in the occupied bins, and the occupied bins' 
+            flattened indices.
+        """
+        flat_idx, w = self._flat_indices(x, y, w)
+        if flat_idx.shape[0] == 0:
+            return np.zeros(0), np.zeros(0, dtype=np.int64), flat_idx
+        order = np.argsort(flat_idx, kind='stable')
+        flat_idx = flat_idx[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(flat_idx))+1))
+        sums = np.add.reduceat(w[order], starts, dtype=np.float64)
+        counts = np.diff(np.append(starts, flat_idx.shape[0]))
+        return sums, counts, flat_idx[starts]
+
+    def _flat_indices(self, x, y, w):
+        """
+        Find the flattened x-y bin index of each sample in the map.
+
+        Returns
+        -------
+        flat_idx, w: np.array
+            The flattened bin indices and the precipitation values of the 
+            samples in the map.
+        """
+        # Compare and rescale the float32 samples in float64, like the 
+        # compiled kernel.
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        # Reject the samples outside of the map (and NaNs) in one pass. The 
+        # bins include their end edge, but not their start edge.
+        valid = (
+            (x > self.x_bins[0]) & (x <= self.x_bins[-1]) &
+            (y > self.y_bins[0]) & (y <= self.y_bins[-1])
+            )
+        x, y, w = x[valid], y[valid], w[valid]
+        n_x, n_y = self._sum.shape
+
+        if self._uniform_bins:
+            i = np.ceil((x-self.x_bins[0])*self._x_inv).astype(np.intp) - 1
+            j = np.ceil((y-self.y_bins[0])*self._y_inv).astype(np.intp) - 1
+            # _exact_bin_arithmetic() already checked the edges, but keep 
+            # the indices inside the map to be safe.
+            np.clip(i, 0, n_x-1, out=i)
+            np.clip(j, 0, n_y-1, out=j)
+        else:
+            # side='left' puts the samples on an edge in the bin that ends 
+            # there, like the other binning paths.
+            i = np.searchsorted(self.x_bins, x, side='left') - 1
+            j = np.searchsorted(self.y_bins, y, side='left') - 1
+        return i*n_y + j, w
+
+
+# Use Bin_Data._sparse_histogram if the map has this many more bins than 
+# the chunk has samples. Below that, allocating and adding the full grids is
+# cheaper than sorting the samples.
+_SPARSE_BINS_PER_SAMPLE = 64
+
+# The Bin_Data and instrument objects in each worker process.
+_worker_state = {}
+
+
+def _init_worker(bin_data: Bin_Data, instrument):
+    """
+    Save the Bin_Data and instrument objects in a new worker process.
+    """
+    _worker_state['bin_data'] = bin_data
+    _worker_state['instrument'] = instrument
+    # Silence the instrument's prints, which would break up the progress bar
+    # drawn by the main process.
+    sys.stdout = open(os.devnull, 'w')
+    return
+
+
+def _bin_day(date):
+    """
+    Load and bin one day in a worker process.
+
+    Returns
+    -------
+    tuple or None
+        The day's (sums, counts) grids, or None if the instrument skipped 
+        the day.
+    """
+    data = _worker_state['instrument'].load_day(date)
+    if data is None:
+        return None
+    return _worker_state['bin_data']._sum_and_count(data)
+
+
+def _is_uniform(bins: np.array) -> bool:
+    """
+    Check if the bin edges are evenly spaced, up to round-off.
+    """
+    widths = np.diff(bins)
+    return bool(np.allclose(widths, widths[0], rtol=1e-9, atol=0))
+
+
+def _exact_bin_arithmetic(bins: np.array, inv: float) -> bool:
+    """
+    Check that ceil((value-bins[0])*inv)-1 is the (start, end] bin of every 
+    value. The arithmetic never decreases as the value increases, so it is 
+    enough to check the values on each edge and the next float above it.
+    """
+    bins = np.asarray(bins, dtype=np.float64)
+    k = np.arange(bins.shape[0])
+    on_edge = np.ceil((bins-bins[0])*inv)
+    above_edge = np.ceil((np.nextafter(bins, np.inf)-bins[0])*inv)
+    return bool(np.array_equal(on_edge, k) and np.array_equal(above_edge, k+1))
@@ -1,6 +1,9 @@
 from datetime import datetime
+import os
 import pathlib
 import re
+import warnings
+from typing import Union
 
 import numpy as np
 import pandas as pd
@@ -8,9 +11,23 @@ import sampex
 import matplotlib.pyplot as plt
 import matplotlib.colors
 
+from spi_precipitation_maps import _binning
 from spi_precipitation_maps.bin_data import Bin_Data
 from spi_precipitation_maps.dial import Dial
 
+try:
+    import pyarrow
+except ImportError:
+    # pyarrow is optional, the HILT files are read by the pandas C parser.
+    pyarrow = None
+
+# The HILT file names start with hhrrYYYYDOY, so the date is in this slice.
+_HILT_DATE_SLICE = slice(4, 11)
+# The sampex error messages of the days that are skipped instead of raised.
+_SKIP_MSGS = (
+    'A matched file not found in',  # HILT data without attitude data.
+)
+
 
 class Bin_SAMPEX_HILT:
     """
@@ -19,8 +36,56 @@ class Bin_SAMPEX_HILT:
     If you have the SAMPEX-HILT data downloaded already, check that the
     sampex.config['data_dir'] points to that directory. Run 
     `python3 -m sampex init` in the command line to change that directory.
+
+    Parameters
+    ----------
+    x_col, y_col: str
+        The attitude columns to bin by.
+    precipitation_col: str
+        The HILT column to bin.
+    use_cache: bool
+        Save each day's matched arrays to an npz file in cache_dir, and load 
+        them instead of the SAMPEX files on the next run. Each day takes 
+        about 4 MB, or about 20 GB for the whole mission. If cache_dir can't
+        be written to, a warning is issued and the cache is turned off.
+    cache_dir: str or pathlib.Path
+        The cache directory. If None, it is the 
+        spi_precipitation_maps/sampex_hilt/ folder in the user's cache 
+        directory, $XDG_CACHE_HOME or ~/.cache/.
+    arrow: bool
+        Read the HILT files with pyarrow's multithreaded csv parser. Requires
+        pyarrow, otherwise the default pandas parser is used.
+
+    Example
+    -------
+    Bin_Data passes the instrument_kwargs to this class, e.g.,
+    Bin_Data(L_bins, MLT_bins, 'L_Shell', 'MLT', 'counts', Bin_SAMPEX_HILT,
+    instrument_kwargs={'use_cache':False, 'arrow':True}).
     """
-    def __init__(self,) -> None:
+    def __init__(
+        self, x_col: str='L_Shell', y_col: str='MLT', precipitation_col: str='counts',
+        use_cache: bool=True, cache_dir: Union[str, pathlib.Path]=None,
+        arrow: bool=False
+        ) -> None:
+        self.x_col = x_col
+        self.y_col = y_col
+        self.precipitation_col = precipitation_col
+        self.use_cache = use_cache
+        if cache_dir is None:
+            # Keep the cache out of the SAMPEX data directory, which may be 
+            # read-only or shared, and is searched for the SAMPEX files.
+            cache_home = os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache')
+            self.cache_dir = pathlib.Path(cache_home) / 'spi_precipitation_maps' / 'sampex_hilt'
+        else:
+            self.cache_dir = pathlib.Path(cache_dir)
+        if self.use_cache:
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+            except OSError as err:
+                self._disable_cache(err)
+        if arrow and (pyarrow is None):
+            warnings.warn('pyarrow is not installed, so the HILT files are read by pandas.')
+        self._hilt_class = _Arrow_HILT if (arrow and (pyarrow is not None)) else sampex.HILT
         self._get_dates()
         return
 
@@ -29,27 +94,77 @@ class Bin_SAMPEX_HILT:
         The special method called by the Bin_Data class.
         """
         for date in self.dates:
-            print(f'Processing SAMPEX-HILT on {date.date()}')
-            self.hilt = sampex.HILT(date).load()
+            data = self.load_day(date)
+            if data is None:
+                continue
+            yield data
 
+    def load_day(self, date: datetime) -> dict:
+        """
+        Load the HILT and attitude data on date and match each HILT sample to 
+        the nearest attitude sample. Bin_Data calls this method directly when 
+        it bins the days in parallel.
+
+        Parameters
+        ----------
+        date: datetime
+            The day to load.
+
+        Returns
+        -------
+        dict or None
+            The x_col, y_col, and precipitation_col values as float32 arrays 
+            under the "x", "y", and "w" keys, or None if the day can't be used.
+        """
+        print(f'Processing SAMPEX-HILT on {date.date()}')
+        if self.use_cache and self._cache_path(date).exists():
+            with np.load(self._cache_path(date)) as cached:
+                return {key:cached[key] for key in ['x', 'y', 'w']}
+
+        self.hilt = self._hilt_class(date).load()
+
+        try:
+            self.attitude = sampex.Attitude(date).load()
+        except ValueError as err:
+            if any(msg in str(err) for msg in _SKIP_MSGS):
+                return None
+            raise
+        # Skip the days with unordered timestamps, as pd.merge_asof did.
+        if not (self.hilt.index.is_monotonic_increasing and 
+                self.attitude.index.is_monotonic_increasing):
+            return None
+        # Match each HILT sample to the nearest attitude sample within 3 
+        # seconds. The unmatched samples get NaN attitude values, which 
+        # Bin_Data does not bin.
+        idx = _nearest_index(
+            _to_ns(self.hilt.index), _to_ns(self.attitude.index), 
+            pd.Timedelta(seconds=3).value
+            )
+        matched = idx >= 0
+        if not np.any(matched):
+            return None
+        # float32 halves the memory traffic, and is precise enough for the 
+        # HILT counts and the L-MLT bins. Bin_Data still sums in float64.
+        data = {'w':self.hilt[self.precipitation_col].to_numpy(dtype=np.float32)}
+        for key, col in [('x', self.x_col), ('y', self.y_col)]:
+            data[key] = self.attitude[col].to_numpy(dtype=np.float32)[idx]
+            data[key][~matched] = np.nan
+
+        if self.use_cache:
+            # Write to a temporary file first so an interrupted run can't 
+            # leave a truncated cache file.
+            cache_path = self._cache_path(date)
+            tmp_path = cache_path.with_name(cache_path.name + '.tmp')
             try:
-                self.attitude = sampex.Attitude(date).load()
-            except ValueError as err:
-                # Sometimes there is HILT data without corresponding attitude data.
-                if 'A matched file not found in' in str(err):
-                    continue
-                else:
-                    raise
-            try:
-                merged_df = pd.merge_asof(self.hilt, self.attitude, left_index=True, 
-                    right_index=True, tolerance=pd.Timedelta(seconds=3), 
-                    direction='nearest')
-            except ValueError as err:
-                if 'keys must be sorted' in str(err):
-                    continue
-                else:
-                    raise
-            yield merged_df
+                with open(tmp_path, 'wb') as f:
+                    np.savez_compressed(f, **data)
+                os.replace(tmp_path, cache_path)
+            except OSError as err:
+                # E.g., the disk is full.
+                if tmp_path.exists():
+                    tmp_path.unlink()
+                self._disable_cache(err)
+        return data
 
     def __len__(self):
         """
@@ -57,17 +172,39 @@ class Bin_SAMPEX_HILT:
         """
         return len(self.dates)
 
+    def _disable_cache(self, err: OSError):
+        """
+        Warn that the cache can't be written, and turn it off.
+        """
+        warnings.warn(
+            f'Turning off the SAMPEX-HILT cache since {self.cache_dir} can\'t be '
+            f'written to ({err}). Pass a different cache_dir in instrument_kwargs.'
+            )
+        self.use_cache = False
+        return
+
+    def _cache_path(self, date: datetime) -> pathlib.Path:
+        """
+        The cache file path for date. The file name includes the column names
+        so the caches of different columns don't collide.
+        """
+        return self.cache_dir / (
+            f'{date:%Y%m%d}_{self.x_col}_{self.y_col}_{self.precipitation_col}.npz'
+            )
+
     def _get_dates(self):
         """
         Finds the SAMPEX files and converts the filenames into dates.
         """
-        # Look for local SAMPEX files.
+        # Look for local SAMPEX files. os.walk is faster than pathlib's rglob.
         file_name_glob = f"hhrr*"
         self.hilt_paths = sorted(
-            pathlib.Path(sampex.config['data_dir']).rglob(file_name_glob))
+            pathlib.Path(root) / name
+            for root, _, names in os.walk(sampex.config['data_dir'])
+            for name in names if name.startswith('hhrr')
+            )
         if len(self.hilt_paths):
-            date_strs = [re.findall(r"\d+", str(f.name))[0] for f in self.hilt_paths]
-            self.dates = [sampex.load.yeardoy2date(date_str) for date_str in date_strs]
+            file_names = [f.name for f in self.hilt_paths]
         else:
             # Otherwise get the list of filenames online.
             downloader = sampex.Downloader(
@@ -76,16 +213,97 @@ class Bin_SAMPEX_HILT:
             downloaders = downloader.ls(file_name_glob)
             assert len(downloaders), f'{len(downloaders)} HILT files found at {downloader.url}'
 
-            date_strs = [re.findall(r"\d+", str(d.name()))[0] for d in downloaders]
-            self.dates = [sampex.load.yeardoy2date(date_str) for date_str in date_strs]
+            file_names = [d.name() for d in downloaders]
+        self.dates = _file_dates(file_names)
         self.dates = [date for date in self.dates if date > datetime(1997, 1, 1)]
         return self.dates
 
+
+class _Arrow_HILT(sampex.HILT):
+    """
+    sampex.HILT that parses the HILT text files with pyarrow's csv reader.
+    """
+    def read_csv(self, path):
+        """
+        Reads in the CSV file given either the filename or the 
+        zip file reference
+        """
+        if self.verbose:
+            print(f"Loading SAMPEX-HILT data on {self.load_date.date()} from {path.name}")
+        self._hilt_csv = pd.read_csv(path, sep=" ", engine="pyarrow")
+        return
+
+
+def _file_dates(file_names: list) -> list:
+    """
+    Convert the HILT file names into dates.
+    """
+    date_strs = [file_name[_HILT_DATE_SLICE] for file_name in file_names]
+    try:
+        # Parse all of the dates at once instead of calling 
+        # sampex.load.yeardoy2date() on each one.
+        return list(pd.to_datetime(date_strs, format='%Y%j').to_pydatetime())
+    except ValueError:
+        # Some file names are not hhrrYYYYDOY*, so fall back to the first 
+        # number in each file name.
+        return [
+            sampex.load.yeardoy2date(re.findall(r"\d+", file_name)[0]) 
+            for file_name in file_names
+            ]
+
+
+def _to_ns(index: pd.Index) -> np.array:
+    """
+    Convert a time index to an int64 array of nanoseconds since the epoch.
+    """
+    return np.asarray(index, dtype='datetime64[ns]').view(np.int64)
+
+
+def _nearest_index(times: np.array, ref_times: np.array, tolerance: int) -> np.array:
+    """
+    Find the index of the nearest ref_times sample for each sample in times,
+    like pd.merge_asof(..., direction='nearest'). If numba is installed, the
+    arrays are walked once by a compiled kernel, otherwise np.searchsorted
+    finds the neighboring samples.
+
+    Parameters
+    ----------
+    times: np.array
+        The sorted times to match.
+    ref_times: np.array
+        The sorted reference times.
+    tolerance: int
+        The maximum allowed time difference between the matched samples.
+
+    Returns
+    -------
+    np.array
+        The ref_times indices, or -1 if the nearest ref_times sample is further
+        than tolerance away.
+    """
+    if _binning.nearest_index is not None:
+        return _binning.nearest_index(times, ref_times, tolerance)
+    if ref_times.shape[0] == 0:
+        return np.full(times.shape, -1)
+    # The last ref_times sample at or before each time (the last one of any
+    # duplicates), and the sample after it.
+    left = np.searchsorted(ref_times, times, side='right') - 1
+    np.clip(left, 0, ref_times.shape[0]-1, out=left)
+    right = np.minimum(left+1, ref_times.shape[0]-1)
+    # Prefer the earlier sample on ties, as pd.merge_asof does.
+    use_left = np.abs(times-ref_times[left]) <= np.abs(ref_times[right]-times)
+    idx = np.where(use_left, left, right)
+    idx[np.abs(ref_times[idx]-times) > tolerance] = -1
+    return idx
+
 if __name__ == '__main__':
     L_bins = np.arange(2, 11)
     MLT_bins = np.arange(0, 24.1)
 
-    m = Bin_Data(L_bins, MLT_bins, 'L_Shell', 'MLT', 'counts', Bin_SAMPEX_HILT)
+    m = Bin_Data(
+        L_bins, MLT_bins, 'L_Shell', 'MLT', 'counts', Bin_SAMPEX_HILT, 
+        instrument_kwargs={'arrow':pyarrow is not None}
+        )
     try:
         m.bin()
     finally:
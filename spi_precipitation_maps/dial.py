@@ -11,6 +11,9 @@ class Dial:
         self.angular_bins = angular_bins
         self.radial_bins = radial_bins
         self.H = H
+        # The mesh grid is reused by every draw_dial() call.
+        self._theta_grid, self._r_grid = np.meshgrid(
+            np.asarray(self.angular_bins)*np.pi/12, self.radial_bins)
 
         if 'Polar' not in str(type(ax)):
             raise ValueError('Subplot is not polar. For example, '
@@ -29,8 +32,9 @@ class Dial:
         # Turn off the grid to prevent a matplotlib deprecation warning 
         # (see https://matplotlib.org/3.5.1/api/prev_api_changes/api_changes_3.5.0.html#auto-removal-of-grids-by-pcolor-and-pcolormesh)
         self.ax.grid(False) 
-        angular_grid, radial_grid = np.meshgrid(self.angular_bins, self.radial_bins)
-        p = self.ax.pcolormesh(angular_grid*np.pi/12, radial_grid, self.H, **mesh_kwargs)
+        # Explicit flat shading skips matplotlib's shading inference.
+        mesh_kwargs = {'shading':'flat', **mesh_kwargs}
+        p = self.ax.pcolormesh(self._theta_grid, self._r_grid, self.H, **mesh_kwargs)
         
 
         self.draw_earth()
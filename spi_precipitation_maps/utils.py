@@ -1,7 +1,13 @@
 from typing import Iterable
 import shutil
+import sys
+import queue
+import threading
 
-def progressbar(iterator: Iterable, iter_length: int=None, text: str=None):
+def progressbar(
+        iterator: Iterable, iter_length: int=None, text: str=None, 
+        redirect_stdout: bool=False
+        ):
     """
     A terminal progress bar.
     Parameters
@@ -13,6 +19,9 @@ def progressbar(iterator: Iterable, iter_length: int=None, text: str=None):
         using len(iterator).
     text: str
         Insert an optional text string in the beginning of the progressbar. 
+    redirect_stdout: bool
+        Print the lines printed by the loop above the progress bar, instead
+        of in the middle of it.
     """
     if text is None:
         text = ''
@@ -22,18 +31,129 @@ def progressbar(iterator: Iterable, iter_length: int=None, text: str=None):
     if iter_length is None:
         iter_length = len(iterator)
 
+    # Check the terminal width once, instead of on every iteration.
+    terminal_cols = shutil.get_terminal_size(fallback=(80, 20)).columns
+    max_cols = int(terminal_cols-len(text)-10)
+    # Prevent a crash if the terminal window is narrower then len(text).
+    if max_cols < 0:
+        max_cols = 0
+
+    stdout = _StdoutAboveBar(sys.stdout)
+    if redirect_stdout:
+        sys.stdout = stdout
+    last_percent = None
     try:
         for i, item in enumerate(iterator):
             i+=1  # So we end at 100%. Happy users!
-            terminal_cols = shutil.get_terminal_size(fallback=(80, 20)).columns
-            max_cols = int(terminal_cols-len(text)-10)
-            # Prevent a crash if the terminal window is narrower then len(text).
-            if max_cols < 0:
-                max_cols = 0
-
             percent = round(100 * i / iter_length)
-            bar = "#" * int(max_cols*percent/100)
-            print(f'{text} |{bar:<{max_cols}}| {percent}%', end='\r') 
+            # Only redraw the bar when it changes.
+            if percent != last_percent:
+                bar = "#" * int(max_cols*percent/100)
+                stdout.draw(f'{text} |{bar:<{max_cols}}| {percent}%') 
+                last_percent = percent
+            yield item
+    finally:
+        if redirect_stdout:
+            sys.stdout = stdout.stdout
+        stdout.close()  # end with a newline.
+
+
+class _StdoutAboveBar:
+    """
+    A sys.stdout replacement that prints each complete line above the 
+    progress bar and then redraws the bar.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.bar = ''
+        self._line = ''
+        # The instrument may print from the prefetch thread.
+        self._lock = threading.Lock()
+        return
+
+    def write(self, text: str):
+        with self._lock:
+            self._line += text
+            if '\n' in self._line:
+                lines, _, self._line = self._line.rpartition('\n')
+                # Blank out the bar before printing over it.
+                self.stdout.write(f'\r{" "*len(self.bar)}\r{lines}\n{self.bar}\r')
+        return len(text)
+
+    def draw(self, bar: str):
+        """
+        Draw the progress bar on the current line.
+        """
+        with self._lock:
+            self.bar = bar
+            self.stdout.write(bar + '\r')
+        return
+
+    def close(self):
+        """
+        Print any unfinished line and end the bar with a newline.
+        """
+        with self._lock:
+            if self._line:
+                self.stdout.write(f'\r{" "*len(self.bar)}\r{self._line}\n')
+                self._line = ''
+            self.stdout.write(f'{self.bar}\n')
+            self.stdout.flush()
+        return
+
+    def flush(self):
+        self.stdout.flush()
+        return
+
+    def __getattr__(self, name):
+        # Everything else (encoding, isatty, ...) comes from the real stdout.
+        return getattr(self.stdout, name)
+
+
+def prefetch(iterable: Iterable, n_items: int=2):
+    """
+    Loop over the iterable in a background thread and yield its items, so 
+    the next items are loaded while the current one is processed.
+
+    Parameters
+    ----------
+    iterable: Iterable
+        The iterable that will be looped over.
+    n_items: int
+        How many items to load ahead of the consumer.
+    """
+    items = queue.Queue(maxsize=n_items)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Time out every so often to check if the consumer stopped.
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            for item in iterable:
+                put((item, None))
+                if stop.is_set():
+                    return
+            put((done, None))
+        except BaseException as err:
+            put((done, err))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
             yield item
     finally:
-        print()  # end with a newline. 
\ No newline at end of file
+        stop.set()
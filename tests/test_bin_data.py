@@ -0,0 +1,185 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from spi_precipitation_maps import _binning
+from spi_precipitation_maps import bin_data
+from spi_precipitation_maps.bin_data import Bin_Data
+
+
+def _loop_sum_and_count(x, y, w, x_bins, y_bins):
+    """
+    The sums and counts of the original loop over the (start, end] bins.
+    """
+    sums = np.zeros((x_bins.shape[0]-1, y_bins.shape[0]-1))
+    counts = np.zeros(sums.shape, dtype=np.int64)
+    for i, (start_x, end_x) in enumerate(zip(x_bins[:-1], x_bins[1:])):
+        for j, (start_y, end_y) in enumerate(zip(y_bins[:-1], y_bins[1:])):
+            in_bin = (x > start_x) & (x <= end_x) & (y > start_y) & (y <= end_y)
+            sums[i, j] = np.sum(w[in_bin])
+            counts[i, j] = np.sum(in_bin)
+    return sums, counts
+
+
+paths = ['numpy', 'sparse']
+if _binning.accumulate is not None:
+    paths.append('numba')
+
+
+@pytest.fixture(params=paths)
+def path(request, monkeypatch):
+    if request.param != 'numba':
+        monkeypatch.setattr(_binning, 'accumulate', None)
+    if request.param == 'sparse':
+        # Use the sparse histogram for every chunk.
+        monkeypatch.setattr(bin_data, '_SPARSE_BINS_PER_SAMPLE', 0)
+    return request.param
+
+
+bins = {
+    'integer':(np.arange(2, 11), np.arange(0, 24.1)),
+    'quarter':(np.linspace(2, 10, 33), np.linspace(0, 24, 97)),
+    'linspace':(np.arange(2, 11), np.linspace(0, 0.3, 8)),
+    'tenths':(np.arange(0, 1.01, 0.1), np.linspace(-3, 3, 13)),
+    'nonuniform':(np.array([2, 3, 4.5, 6, 10]), np.arange(0, 24.1)),
+    }
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('x_bins, y_bins', bins.values(), ids=bins.keys())
+def test_bin_edges(path, x_bins, y_bins, dtype):
+    rng = np.random.default_rng(0)
+    # Samples on every edge, just above and below every edge, and randomly
+    # inside and outside of the map.
+    def edge_values(b):
+        b = np.asarray(b, dtype=dtype)
+        return np.concatenate((
+            b, np.nextafter(b, np.inf, dtype=dtype), np.nextafter(b, -np.inf, dtype=dtype)
+            ))
+    x_edges, y_edges = edge_values(x_bins), edge_values(y_bins)
+    x = np.concatenate((
+        x_edges, rng.choice(x_edges, 5_000), rng.uniform(x_bins[0]-1, x_bins[-1]+1, 5_000), [np.nan]
+        )).astype(dtype)
+    y = np.concatenate((
+        rng.choice(y_edges, x_edges.shape[0]), y_edges[rng.integers(0, y_edges.shape[0], 5_000)], 
+        rng.uniform(y_bins[0]-1, y_bins[-1]+1, 5_000), [0]
+        )).astype(dtype)
+    w = rng.poisson(10, x.shape[0]).astype(dtype)
+
+    m = Bin_Data(x_bins, y_bins, 'x', 'y', 'w', None)
+    m._bin_data({'x':x, 'y':y, 'w':w})
+    sums, counts = _loop_sum_and_count(
+        x.astype(np.float64), y.astype(np.float64), w.astype(np.float64), x_bins, y_bins
+        )
+    np.testing.assert_array_equal(m.mean_sampes, counts)
+    np.testing.assert_allclose(m._sum, sums)
+
+
+def test_is_uniform():
+    assert bin_data._is_uniform(np.linspace(0, 0.3, 8))
+    assert bin_data._is_uniform(np.arange(0, 1.01, 0.1))
+    assert not bin_data._is_uniform(np.array([0, 1, 2+1e-7]))
+
+
+def test_sparse_chunks():
+    # A wide map and a small chunk, binned twice into the same grids.
+    x_bins, y_bins = np.linspace(0, 1000, 1001), np.arange(0, 24.1)
+    rng = np.random.default_rng(1)
+    x = rng.uniform(-10, 1010, 100).round()
+    y = rng.uniform(-1, 25, 100).round()
+    w = rng.poisson(10, 100).astype(float)
+    m = Bin_Data(x_bins, y_bins, 'x', 'y', 'w', None)
+    assert len(m._sum_and_count({'x':x, 'y':y, 'w':w})) == 3
+    for _ in range(2):
+        m._bin_data({'x':x, 'y':y, 'w':w})
+    sums, counts = _loop_sum_and_count(x, y, w, x_bins, y_bins)
+    np.testing.assert_array_equal(m.mean_sampes, 2*counts)
+    np.testing.assert_allclose(m._sum, 2*sums)
+
+
+class _Days:
+    """
+    A fake instrument that yields a few days of random samples as DataFrames
+    and dicts, and prints like Bin_SAMPEX_HILT.
+    """
+    def __init__(self, n_days=7, fail_on=None):
+        self.n_days = n_days
+        self.fail_on = fail_on
+
+    def __iter__(self):
+        rng = np.random.default_rng(2)
+        for day in range(self.n_days):
+            print(f'Processing day {day}')
+            if day == self.fail_on:
+                raise RuntimeError(f'day {day} failed')
+            data = {
+                'x':rng.uniform(1, 11, 1_000), 'y':rng.uniform(-1, 25, 1_000), 
+                'w':rng.poisson(10, 1_000).astype(float)
+                }
+            yield pd.DataFrame(data) if day % 2 else data
+
+    def __len__(self):
+        return self.n_days
+
+
+def _bin_days(**kwargs):
+    m = Bin_Data(np.arange(2, 11), np.arange(0, 24.1), 'x', 'y', 'w', _Days)
+    m.bin(**kwargs)
+    return m
+
+
+def test_bin_prefetch():
+    m = _bin_days()
+    m_prefetch = _bin_days(prefetch=True)
+    np.testing.assert_array_equal(m_prefetch.mean_sampes, m.mean_sampes)
+    np.testing.assert_array_equal(m_prefetch._sum, m._sum)
+
+
+def test_bin_prefetch_error():
+    stdout = sys.stdout
+    m = Bin_Data(
+        np.arange(2, 11), np.arange(0, 24.1), 'x', 'y', 'w', _Days, 
+        instrument_kwargs={'fail_on':3}
+        )
+    with pytest.raises(RuntimeError, match='day 3 failed'):
+        m.bin(prefetch=True)
+    assert sys.stdout is stdout
+
+
+@pytest.mark.parametrize('batch_size', [2, 3, 7, 30])
+def test_bin_batches(batch_size):
+    m = _bin_days()
+    m_batched = _bin_days(batch_size=batch_size)
+    np.testing.assert_array_equal(m_batched.mean_sampes, m.mean_sampes)
+    np.testing.assert_allclose(m_batched._sum, m._sum)
+
+
+@pytest.mark.parametrize('batch_size', [0, -1])
+def test_bin_bad_batch_size(batch_size):
+    with pytest.raises(ValueError):
+        _bin_days(batch_size=batch_size)
+
+
+def test_save_map_npz(tmp_path):
+    m = _bin_days()
+    save_path = m.save_map('map.npz', save_dir=tmp_path)
+    assert save_path == tmp_path / 'map.npz'
+    with np.load(save_path) as saved:
+        np.testing.assert_array_equal(saved['mean'], m.mean)
+        np.testing.assert_array_equal(saved['count'], m.mean_sampes)
+        np.testing.assert_array_equal(saved['x_bins'], m.x_bins)
+        np.testing.assert_array_equal(saved['y_bins'], m.y_bins)
+    # The temporary file was renamed to the map.
+    assert [path.name for path in tmp_path.iterdir()] == ['map.npz']
+
+
+def test_save_map_csv(tmp_path):
+    m = _bin_days()
+    save_path = m.save_map('map.csv', save_dir=tmp_path)
+    saved = pd.read_csv(save_path, index_col=0)
+    np.testing.assert_allclose(saved.to_numpy(), m.mean)
+    np.testing.assert_allclose(saved.index, m.x_bins[:-1])
+    np.testing.assert_allclose(saved.columns.astype(float), m.y_bins[:-1])
+    assert [path.name for path in tmp_path.iterdir()] == ['map.csv']
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from spi_precipitation_maps import _binning
+from spi_precipitation_maps import bin_sampex_hilt
+
+
+def _merge_asof_index(times, ref_times, tolerance):
+    """
+    The ref_times index matched to each time by pd.merge_asof, or -1.
+    """
+    left = pd.DataFrame({'t':times})
+    right = pd.DataFrame({'t':ref_times, 'i':np.arange(ref_times.shape[0])})
+    merged = pd.merge_asof(left, right, on='t', direction='nearest', tolerance=tolerance)
+    return merged['i'].fillna(-1).to_numpy(dtype=np.int64)
+
+
+def _numpy_nearest_index(times, ref_times, tolerance, monkeypatch):
+    monkeypatch.setattr(_binning, 'nearest_index', None)
+    return bin_sampex_hilt._nearest_index(times, ref_times, tolerance)
+
+
+matchers = {
+    'kernel':lambda times, ref_times, tolerance, monkeypatch: 
+        _binning._nearest_index(times, ref_times, tolerance),
+    'numpy':_numpy_nearest_index,
+    }
+if _binning.nearest_index is not None:
+    matchers['numba'] = lambda times, ref_times, tolerance, monkeypatch: \
+        _binning.nearest_index(times, ref_times, tolerance)
+
+
+@pytest.mark.parametrize('matcher', matchers.values(), ids=matchers.keys())
+def test_duplicate_ref_times(matcher, monkeypatch):
+    ref_times = np.array([0, 5, 5, 10, 20], dtype=np.int64)
+    times = np.array([1, 4, 5, 6, 7, 9, 10, 15, 19, 40], dtype=np.int64)
+    idx = matcher(times, ref_times, 3, monkeypatch)
+    np.testing.assert_array_equal(idx, [0, 1, 2, 2, 2, 3, 3, -1, 4, -1])
+    np.testing.assert_array_equal(idx, _merge_asof_index(times, ref_times, 3))
+
+
+@pytest.mark.parametrize('matcher', matchers.values(), ids=matchers.keys())
+def test_random_times(matcher, monkeypatch):
+    rng = np.random.default_rng(0)
+    # Coarse times so there are duplicates, ties, and unmatched samples.
+    ref_times = np.sort(rng.integers(0, 10_000, 2_000))
+    times = np.sort(rng.integers(-100, 10_100, 5_000))
+    idx = matcher(times, ref_times, 3, monkeypatch)
+    np.testing.assert_array_equal(idx, _merge_asof_index(times, ref_times, 3))
+    assert np.any(idx == -1)
+
+
+@pytest.mark.parametrize('matcher', matchers.values(), ids=matchers.keys())
+def test_no_ref_times(matcher, monkeypatch):
+    times = np.array([1, 2, 3], dtype=np.int64)
+    idx = matcher(times, np.array([], dtype=np.int64), 3, monkeypatch)
+    np.testing.assert_array_equal(idx, [-1, -1, -1])
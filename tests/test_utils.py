@@ -0,0 +1,69 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from spi_precipitation_maps.utils import prefetch, progressbar
+
+
+def test_prefetch_order():
+    assert list(prefetch(range(100), n_items=3)) == list(range(100))
+
+
+def test_prefetch_producer_error():
+    def failing():
+        yield from range(3)
+        raise ValueError('producer failed')
+
+    items = []
+    with pytest.raises(ValueError, match='producer failed'):
+        for item in prefetch(failing()):
+            items.append(item)
+    assert items == [0, 1, 2]
+
+
+def test_prefetch_consumer_stops_early():
+    produced = []
+    def endless():
+        i = 0
+        while True:
+            produced.append(i)
+            yield i
+            i += 1
+
+    n_threads = threading.active_count()
+    items = prefetch(endless(), n_items=2)
+    assert [next(items) for _ in range(3)] == [0, 1, 2]
+    items.close()
+    # The producer thread notices the stop and exits.
+    for _ in range(100):
+        if threading.active_count() == n_threads:
+            break
+        time.sleep(0.05)
+    assert threading.active_count() == n_threads
+    n_produced = len(produced)
+    time.sleep(0.2)
+    assert len(produced) == n_produced
+
+
+def test_progressbar_prints_above_bar(capsys):
+    for i in progressbar(range(3), redirect_stdout=True):
+        print(f'item {i}')
+    out = capsys.readouterr().out
+    lines = out.split('\n')
+    # Each printed line starts on a fresh line after the bar is blanked out.
+    assert [line.split('\r')[-1] for line in lines if 'item' in line] == \
+        ['item 0', 'item 1', 'item 2']
+    assert '100%' in lines[-2]
+
+
+def test_progressbar_restores_stdout_after_error(capsys):
+    stdout = sys.stdout
+    with pytest.raises(RuntimeError):
+        for i in progressbar(range(10), redirect_stdout=True):
+            print('unfinished line', end='')
+            if i == 3:
+                raise RuntimeError
+    assert sys.stdout is stdout
+    assert 'unfinished line' in capsys.readouterr().out